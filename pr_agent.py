@@ -1,28 +1,96 @@
 import os
-import requests
+import asyncio
+import functools
+import hashlib
+import html
 import json
-from github import Github
-
-# --- Configuration ---
-OLLAMA_URL = os.environ.get("OLLAMA_URL")
-OLLAMA_MODEL = os.environ.get("OLLAMA_MODEL")
-GITHUB_TOKEN = os.environ.get("GITHUB_TOKEN")
+import re
 
 # PR Context from GitHub Actions
 repo_name = os.environ.get("GITHUB_REPOSITORY")
-pr_number = os.environ.get("GITHUB_EVENT_PULL_REQUEST_NUMBER") or \
-            json.loads(os.environ.get("GITHUB_EVENT_PATH")).get('pull_request', {}).get('number')
+# GITHUB_PR_NUMBER is exported by the workflow; pull_request events also set GITHUB_REF=refs/pull/<n>/merge
+ref_match = re.match(r"refs/pull/(\d+)/", os.environ.get("GITHUB_REF", ""))
+pr_number = int(os.environ.get("GITHUB_PR_NUMBER") or (ref_match and ref_match.group(1)) or 0)
 
 if not pr_number:
     print("CRITICAL: Could not determine PR number. Exiting.")
     exit(0)
 
+# The client libraries are slow to import (PyGithub, pydantic via ollama), so load them only once
+# there is a PR to review
+import httpx
+import ollama
+import github
+from github.PullRequest import PullRequest
+
+# --- Configuration ---
+OLLAMA_URL = os.environ.get("OLLAMA_URL")
+OLLAMA_MODEL = os.environ.get("OLLAMA_MODEL")
+# AsyncClient wants the server root, not the /api/generate endpoint
+OLLAMA_HOST = OLLAMA_URL.split("/api/")[0]
+# In-flight requests are capped at the server's parallel slots so extra files queue here, not in Ollama
+OLLAMA_NUM_PARALLEL = int(os.environ.get("OLLAMA_NUM_PARALLEL", "4"))
+GITHUB_TOKEN = os.environ.get("GITHUB_TOKEN")
+
+# One shared client, so its keep-alive pool reuses connections across the per-file requests.
+# OLLAMA_URL is plain http://, so this is HTTP/1.1 with one connection per in-flight request
+# (the semaphore in run_ollama_agent caps those at OLLAMA_NUM_PARALLEL); httpx's default pool limits suffice.
+CLIENT = ollama.AsyncClient(host=OLLAMA_HOST, timeout=httpx.Timeout(300.0, connect=10.0))
+
 # Initialize GitHub API
-g = Github(GITHUB_TOKEN)
-repo = g.get_repo(repo_name)
-pr = repo.get_pull(pr_number)
+g = github.Github(GITHUB_TOKEN, per_page=100)
+# Lazy repo skips the /repos GET. The PR is lazy too, but reading pr.title below still triggers one
+# /pulls/{n} GET, which also fills in head.sha for the file-list cache.
+repo = g.get_repo(repo_name, lazy=True)
+pr = PullRequest(repo.requester, {}, {"url": f"{repo.url}/pulls/{pr_number}", "number": pr_number}, completed=False)
+
+# The file list is fetched directly so each page can be revalidated with its ETag (304s are free)
+GITHUB_HEADERS = {"Authorization": f"Bearer {GITHUB_TOKEN}", "Accept": "application/vnd.github+json"}
+FILES_URL = f"/repos/{repo_name}/pulls/{pr_number}/files"
+FILES_PER_PAGE = 100 # API maximum, a third of the round-trips of the default 30
+
+# File list cache (with per-page ETags), keyed on the head commit so re-runs of the same push skip the API
+DIFF_CACHE_PATH = f"/tmp/pr_{pr_number}.json"
+# Per-file reviews, restored by actions/cache and keyed by each file's prompt digest, so only new,
+# changed or previously failed files go to the LLM
+REVIEW_CACHE_PATH = "/tmp/review.json"
+# Hidden marker identifying the agent's comment, so reruns edit it in place. It carries the diff digest
+# only when every file was reviewed, so a run after a partial review goes on to retry the failed files.
+REVIEW_MARKER = re.compile(r"<!-- ai-review:v1(?: digest=([0-9a-f]{64}))? -->")
+# Comments posted with the workflow's GITHUB_TOKEN; installation tokens can't call /user to look this up
+REVIEW_AUTHOR = "github-actions[bot]"
+
+# Prompt size limits: prefill cost grows linearly with input tokens
+SKIP_SUFFIXES = (".lock", ".min.js", ".min.css", ".map", "package-lock.json") # Lock/generated files
+MAX_HUNKS_PER_FILE = 20
+PROMPT_TOKEN_BUDGET = 6000 # Per file, i.e. per request; larger diffs are summarized, never dropped
+LARGE_DIFF_EDGE_LINES = 40 # Lines kept from each end of an oversized file
+CHANGED_LINE = re.compile(r"^[+-].*\S") # Added/removed lines that aren't whitespace-only
+try:
+    import tiktoken
+    ENCODING = tiktoken.get_encoding("cl100k_base") # Downloads the BPE file on first use
+except Exception as e: # Not installed, or the download failed
+    print(f"WARNING: tiktoken unavailable ({e}); estimating ~4 characters per token.")
+    ENCODING = None
+
+MAX_SUGGESTIONS = 3 # Kept in the merged review
+NUM_PREDICT = 512 # Cap on reply tokens; also reserved in the context window
+# Keeps the model loaded from the warm-up through the last review request. It doesn't carry over to later
+# runs: the service container (and the model with it) is destroyed when the job ends.
+KEEP_ALIVE = "30m"
 
 # --- 1. Define LLM Prompt and Structure ---
+# Ollama constrains decoding to this schema, so the reply is always parseable JSON
+REVIEW_SCHEMA = {
+    "type": "object",
+    "required": ["summary", "security_risks", "suggestions"],
+    "properties": {
+        "summary": {"type": "string"},
+        "security_risks": {"type": "array", "items": {"type": "string"}},
+        "suggestions": {"type": "array", "items": {"type": "string", "maxLength": 500}},
+    },
+}
+
 SYSTEM_PROMPT = """You are an expert Senior Software Engineer AI. Your task is to perform a concise code review of the provided Pull Request (PR) diff.
 Focus on security, maintainability, and best practices. Respond ONLY with a JSON object that strictly adheres to the following structure:
 {
@@ -34,69 +102,341 @@ Do not include any introductory or concluding text outside of the JSON block. If
 
 # Get the PR content and diff
 pr_title = pr.title
-pr_diff = pr.get_files() # Get files changed
-diff_content = "\n\n".join([f"File: {f.filename}\nDiff:\n{f.patch}\n---" for f in pr_diff])
 
-FULL_PROMPT = f"""PR Title: {pr_title}
+async def fetch_files_page(client, page, cached_page):
+    """Fetches one page of the PR file list as {etag, full, files}, reusing cached_page on a 304.
+
+    Also returns the last page number from the Link header, or None on a 304.
+    """
+    headers = {"If-None-Match": cached_page['etag']} if cached_page else {}
+    response = await client.get(FILES_URL, params={"per_page": FILES_PER_PAGE, "page": page}, headers=headers)
+    if response.status_code == 304:
+        return cached_page, None
+
+    response.raise_for_status()
+    raw_files = response.json()
+    files = [
+        {"filename": f['filename'], "patch": f['patch']}
+        for f in raw_files
+        if f.get('patch')  # Binary files have no patch
+    ]
+    page_data = {"etag": response.headers.get("ETag"), "full": len(raw_files) == FILES_PER_PAGE, "files": files}
+    last = response.links.get("last")
+    return page_data, int(httpx.URL(last['url']).params['page']) if last else page
+
+async def fetch_diff_pages(cached_pages):
+    """Fetches page 1 of the PR file list, then pages 2..N concurrently once the Link header reveals N."""
+    def cached(page):
+        return cached_pages[page - 1] if page <= len(cached_pages) else None
+
+    async with httpx.AsyncClient(base_url="https://api.github.com", http2=True, headers=GITHUB_HEADERS, timeout=30.0) as client:
+        first, last_page = await fetch_files_page(client, 1, cached(1))
+        if last_page is None:
+            last_page = len(cached_pages) # A 304 has no Link header; assume the cached page count
+
+        rest = await asyncio.gather(*(fetch_files_page(client, page, cached(page)) for page in range(2, last_page + 1)))
+        pages = [first] + [page_data for page_data, _ in rest]
+
+        # A full final page (e.g. from the cache) may mean more files were added; read on until a short page
+        while pages[-1]['full']:
+            page_data, _ = await fetch_files_page(client, len(pages) + 1, cached(len(pages) + 1))
+            pages.append(page_data)
+    return pages
+
+@functools.lru_cache(maxsize=None)
+def get_diff_files():
+    """Returns the changed files as [{filename, patch}], cached on disk by head SHA and revalidated by ETag."""
+    head_sha = pr.head.sha
+    cached = {}
+    if os.path.exists(DIFF_CACHE_PATH):
+        with open(DIFF_CACHE_PATH) as fh:
+            cached = json.load(fh)
+
+    if cached.get('head_sha') == head_sha:
+        pages = cached['pages']
+    else:
+        pages = asyncio.run(fetch_diff_pages(cached.get('pages', [])))
+        with open(DIFF_CACHE_PATH, "w") as fh:
+            json.dump({"head_sha": head_sha, "pages": pages}, fh)
+
+    return [f for page in pages for f in page['files']]
+
+def count_tokens(text):
+    return len(ENCODING.encode(text)) if ENCODING else len(text) // 4
+
+def compress_patch(patch):
+    """Keeps only hunk headers and changed lines, capped at MAX_HUNKS_PER_FILE hunks."""
+    lines = []
+    hunks = 0
+    for line in patch.splitlines():
+        if line.startswith('@@'):
+            hunks += 1
+            if hunks > MAX_HUNKS_PER_FILE:
+                break
+            lines.append(line)
+        elif CHANGED_LINE.match(line):
+            lines.append(line)
+    return "\n".join(lines)
+
+def load_large_diff(patch):
+    """Reduces an oversized patch to its hunk headers plus the first/last changed lines."""
+    lines = patch.splitlines()
+    headers = [line for line in lines if line.startswith('@@')]
+    body = [line for line in lines if not line.startswith('@@')]
+    if len(body) > 2 * LARGE_DIFF_EDGE_LINES:
+        omitted = len(body) - 2 * LARGE_DIFF_EDGE_LINES
+        body = body[:LARGE_DIFF_EDGE_LINES] + [f"... ({omitted} lines omitted) ..."] + body[-LARGE_DIFF_EDGE_LINES:]
+    return "\n".join(headers + body)
+
+def truncate_tokens(text, limit):
+    """Cuts text down to at most limit tokens."""
+    if ENCODING:
+        return ENCODING.decode(ENCODING.encode(text)[:limit])
+    return text[:limit * 4]
+
+def trim_diff_files(files):
+    """Drops lock/generated files and compresses each patch to fit PROMPT_TOKEN_BUDGET on its own."""
+    trimmed = []
+    for f in files:
+        if f['filename'].endswith(SKIP_SUFFIXES):
+            continue
+
+        patch = compress_patch(f['patch'])
+        if not patch:
+            continue # Whitespace-only change
+        if count_tokens(patch) > PROMPT_TOKEN_BUDGET:
+            patch = load_large_diff(patch)
+            # Very long lines can keep even the summary over budget
+            if count_tokens(patch) > PROMPT_TOKEN_BUDGET:
+                patch = truncate_tokens(patch, PROMPT_TOKEN_BUDGET)
+
+        trimmed.append({"filename": f['filename'], "patch": patch})
+    return trimmed
+
+diff_files = trim_diff_files(get_diff_files()) # Get files changed
+
+def build_file_prompt(f):
+    """Builds the review prompt for a single changed file."""
+    return f"""PR Title: {pr_title}
 --------------------------------------------------
 CODE DIFF TO REVIEW:
-{diff_content}
+File: {f['filename']}
+Diff:
+{f['patch']}
+---
 """
 
-def run_ollama_agent():
-    """Runs the Ollama model with the structured prompt."""
-    payload = {
-        "model": OLLAMA_MODEL,
-        "prompt": FULL_PROMPT,
+def context_size(prompts):
+    """Sizes num_ctx to the largest prompt plus room for the reply, rounded up to a power of two.
+
+    Ollama allocates the KV cache for the whole context window, so a tight window saves memory traffic.
+    It also reloads the model whenever a request's runner options differ from the loaded runner's, so
+    every request in the run must share the same value.
+    """
+    tokens = count_tokens(SYSTEM_PROMPT) + max(map(count_tokens, prompts), default=0) + NUM_PREDICT
+    return 1 << (tokens - 1).bit_length()
+
+def build_payload(prompt):
+    """Builds the Ollama generate arguments for a single changed file."""
+    return {
+        "prompt": prompt,
         "system": SYSTEM_PROMPT,
-        "format": "json",
-        "stream": False
+        "format": REVIEW_SCHEMA,
+        "keep_alive": KEEP_ALIVE,
+        "options": OLLAMA_OPTIONS,
     }
-    
+
+# One prompt per file so the Ollama server can review them concurrently (OLLAMA_NUM_PARALLEL)
+prompts = [build_file_prompt(f) for f in diff_files]
+
+# Shared by every request so they all fit the one loaded runner.
+# Greedy decoding (temperature 0, top_k 1, no repeat penalty) is deterministic and skips sampling work.
+OLLAMA_OPTIONS = {
+    "num_ctx": context_size(prompts),
+    "num_predict": NUM_PREDICT,
+    "temperature": 0,
+    "top_k": 1,
+    "repeat_penalty": 1.0,
+}
+
+payloads = [build_payload(p) for p in prompts]
+
+def prompt_digest(prompt):
+    return hashlib.sha256(f"{OLLAMA_MODEL}\n{prompt}".encode()).hexdigest()
+
+# Identifies what the model sees for each file, and for the PR as a whole, so no-op synchronize
+# events (e.g. a rebase) can skip the LLM
+file_digests = [prompt_digest(p) for p in prompts]
+diff_digest = hashlib.sha256("\n".join(file_digests).encode()).hexdigest()
+
+def load_cached_reviews():
+    """Returns the cached per-file reviews as {file_digest: review}."""
+    if not os.path.exists(REVIEW_CACHE_PATH):
+        return {}
+    with open(REVIEW_CACHE_PATH) as fh:
+        return json.load(fh).get('files', {})
+
+def save_cached_reviews(reviews):
+    """Persists the successful reviews for the current files, dropping entries for outdated ones."""
+    files = {d: reviews[d] for d in file_digests if reviews.get(d)}
+    with open(REVIEW_CACHE_PATH, "w") as fh:
+        json.dump({"files": files}, fh)
+
+def scan_json(text, state):
+    """Advances a brace-depth scanner over a streamed chunk.
+
+    Returns the index just past the brace that closes the top-level JSON object, or -1 if it
+    hasn't closed yet. Braces inside string literals are ignored.
+    """
+    for i, ch in enumerate(text):
+        if state['in_string']:
+            if state['escape']:
+                state['escape'] = False
+            elif ch == '\\':
+                state['escape'] = True
+            elif ch == '"':
+                state['in_string'] = False
+        elif ch == '"':
+            state['in_string'] = True
+        elif ch == '{':
+            state['depth'] += 1
+        elif ch == '}' and state['depth'] > 0:
+            state['depth'] -= 1
+            if state['depth'] == 0:
+                return i + 1
+    return -1
+
+async def review_file(client, payload):
+    """Reviews a single file's diff and returns the parsed JSON, or None on failure."""
     try:
-        response = requests.post(OLLAMA_URL, json=payload, timeout=300)
-        response.raise_for_status()
-        
-        # Ollama wraps the JSON in a 'response' key
-        result_text = response.json().get('response', '')
-        
-        # Clean up and parse the JSON output
-        # Remove markdown fences (```json...```) if they exist
-        result_text = result_text.strip().replace('```json', '').replace('```', '')
-        
-        return json.loads(result_text)
-    
+        # Stream the tokens and stop as soon as the JSON object closes, so trailing text is never decoded
+        stream = await client.generate(model=OLLAMA_MODEL, stream=True, **payload)
+        parts = []
+        state = {"depth": 0, "in_string": False, "escape": False}
+        try:
+            async for chunk in stream:
+                # Ollama wraps the JSON in a 'response' key
+                text = chunk['response']
+                end = scan_json(text, state)
+                if end != -1:
+                    parts.append(text[:end])
+                    break
+                parts.append(text)
+        finally:
+            # Closes the HTTP stream so Ollama frees the slot for the next request
+            await stream.aclose()
+
+        return json.loads("".join(parts))
+
     except Exception as e:
         print(f"CRITICAL LLM ERROR: {e}")
         return None
 
+def merge_results(results):
+    """Merges the per-file reviews in Python rather than with a second LLM call."""
+    results = [r for r in results if r]
+    if not results:
+        return None
+
+    # dict.fromkeys keeps first-seen order, so equal-length ties sort the same way on every run
+    suggestions = dict.fromkeys(x for r in results for x in r.get('suggestions', []))
+    return {
+        "summary": "; ".join(r['summary'] for r in results if r.get('summary')),
+        "security_risks": sorted({x for r in results for x in r.get('security_risks', [])}),
+        # The longest suggestions tend to be the most specific
+        "suggestions": sorted(suggestions, key=len, reverse=True)[:MAX_SUGGESTIONS],
+    }
+
+async def warm_model():
+    """Loads the model with the review options, so the first review pays neither the load nor a reload."""
+    try:
+        await CLIENT.generate(model=OLLAMA_MODEL, prompt="", keep_alive=KEEP_ALIVE, options=OLLAMA_OPTIONS)
+    except Exception as e:
+        print(f"WARNING: Model warm-up failed: {e}")
+
+async def run_ollama_agent(pending):
+    """Runs the Ollama model over the given payloads concurrently; returns one review (or None) per payload."""
+    sem = asyncio.Semaphore(OLLAMA_NUM_PARALLEL)
+
+    async def one(payload):
+        async with sem:
+            return await review_file(CLIENT, payload)
+
+    return await asyncio.gather(*(one(p) for p in pending))
+
 # --- 2. Execute and Post Results ---
-review_result = run_ollama_agent()
+def escape_cell(text):
+    """HTML-escapes model output and keeps '|' and line breaks from breaking the markdown table."""
+    text = html.escape(str(text)).replace('|', '&#124;')
+    return text.replace('\r\n', '<br>').replace('\r', '<br>').replace('\n', '<br>')
 
-if review_result:
-    # Format the reply for the PR comment
-    comment_body = f"""## 🤖 AI Code Review Summary
+def render_list(items, fallback):
+    return "".join(f"<li>{escape_cell(item)}</li>" for item in items or (fallback,))
 
-| Field | Details |
-| :--- | :--- |
-| **Summary** | {review_result.get('summary', 'N/A')} |
-| **Security Risks** | <ul>{''.join([f'<li>{item}</li>' for item in review_result.get('security_risks', ['None found.'])])}</ul> |
-| **Suggestions** | <ul>{''.join([f'<li>{item}</li>' for item in review_result.get('suggestions', ['No specific suggestions.'])])}</ul> |
-# In pr_agent.py (or any other file in this repo)
+def find_review_comment():
+    """Returns the agent's earlier comment on the PR (found by REVIEW_MARKER), or None.
 
-# Change this:
-# g = Github(GITHUB_TOKEN)
-# To this (adding a comment):
-# Initialize GitHub API for interaction
-g = Github(GITHUB_TOKEN)
+    Only the bot's own comments count: a user comment quoting the marker can't be edited with the
+    workflow token, and its digest must not suppress the review.
+    """
+    for comment in pr.get_issue_comments():
+        if comment.user.login == REVIEW_AUTHOR and REVIEW_MARKER.search(comment.body or ""):
+            return comment
+    return None
 
+def build_comment(review_result, digest):
+    """Formats the reply for the PR comment; digest is None for a partial review."""
+    marker = f"<!-- ai-review:v1 digest={digest} -->" if digest else "<!-- ai-review:v1 -->"
+    header = f"{marker}\n## 🤖 AI Code Review Summary\n\n| Field | Details |\n| :--- | :--- |"
+    summary_row = f"| **Summary** | {escape_cell(review_result.get('summary') or 'N/A')} |"
+    risks_row = f"| **Security Risks** | <ul>{render_list(review_result.get('security_risks'), 'None found.')}</ul> |"
+    suggestions_row = f"| **Suggestions** | <ul>{render_list(review_result.get('suggestions'), 'No specific suggestions.')}</ul> |"
+    footer = f"\n---\n*Review powered by {OLLAMA_MODEL}*"
+    return "\n".join((header, summary_row, risks_row, suggestions_row, footer))
 
+async def main():
+    if not payloads:
+        print("SKIPPED: No reviewable changes (only lock, generated, binary or whitespace-only files).")
+        return
 
----
-*Review powered by {OLLAMA_MODEL}*"""
+    # Start loading the model while the earlier comment is looked up
+    warm_up = asyncio.create_task(warm_model())
+
+    prior_comment = await asyncio.to_thread(find_review_comment)
+    prior_match = prior_comment and REVIEW_MARKER.search(prior_comment.body)
+    if prior_match and prior_match.group(1) == diff_digest:
+        warm_up.cancel()
+        print("SKIPPED: Diff unchanged since the last AI review.")
+        return
+
+    # Cached reviews cover unchanged files, a deleted comment, or a failed post on the same diff
+    reviews = load_cached_reviews()
+    pending = [(d, p) for d, p in zip(file_digests, payloads) if not reviews.get(d)]
+    if pending:
+        await warm_up
+        results = await run_ollama_agent([p for _, p in pending])
+        reviews.update((d, r) for (d, _), r in zip(pending, results) if r)
+        save_cached_reviews(reviews)
+    else:
+        warm_up.cancel()
+
+    results = [reviews.get(d) for d in file_digests]
+    complete = all(results)
+    review_result = merge_results(results)
+
+    if review_result:
+        # Record the digest only for a complete review, so the next run retries the failed files
+        if not complete:
+            print(f"WARNING: {results.count(None)} file(s) could not be reviewed; the next run will retry them.")
+        comment_body = build_comment(review_result, diff_digest if complete else None)
+        # Update the earlier review in place rather than adding a new comment per push
+        if prior_comment:
+            prior_comment.edit(comment_body)
+            print("SUCCESS: AI review comment updated on PR.")
+        else:
+            pr.create_issue_comment(comment_body)
+            print("SUCCESS: AI review comment posted to PR.")
+    else:
+        print("FAILURE: AI agent failed to generate and post a review.")
 
-    # Post the comment to the PR
-    pr.create_issue_comment(comment_body)
-    print("SUCCESS: AI review comment posted to PR.")
-else:
-    print("FAILURE: AI agent failed to generate and post a review.")
+asyncio.run(main())